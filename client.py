@@ -1,19 +1,618 @@
 import tkinter as tk
-from tkinter import ttk, messagebox
+from tkinter import ttk, messagebox, filedialog
 import requests
 import base64
 import threading
 import time
+import json
+import os
+import queue
+import socket
+import struct
+import hmac
+import hashlib
+import secrets
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
 from PIL import Image, ImageTk
 import io
 import pyautogui
 
 
+class ClientStats:
+    def __init__(self, window_size=60, max_events=20000):
+        self.lock = threading.Lock()
+        self.window_size = window_size
+        self.stage_times = {}
+        self.frames = {}
+        self.events = deque(maxlen=max_events)
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name, start, end):
+        with self.lock:
+            if name not in self.stage_times:
+                self.stage_times[name] = deque(maxlen=self.window_size)
+            self.stage_times[name].append((end - start) * 1000)
+            self.events.append((name, start, end, threading.get_ident()))
+
+    def record_value(self, name, value):
+        with self.lock:
+            if name not in self.stage_times:
+                self.stage_times[name] = deque(maxlen=self.window_size)
+            self.stage_times[name].append(value)
+
+    def record_frame(self, kind, size):
+        with self.lock:
+            if kind not in self.frames:
+                self.frames[kind] = deque(maxlen=self.window_size)
+            self.frames[kind].append((time.perf_counter(), size))
+
+    def summary(self, kind):
+        with self.lock:
+            frames = list(self.frames.get(kind, ()))
+            stages = {
+                name: sum(times) / len(times)
+                for name, times in self.stage_times.items() if times
+            }
+
+        fps = 0.0
+        if len(frames) > 1 and frames[-1][0] > frames[0][0]:
+            fps = (len(frames) - 1) / (frames[-1][0] - frames[0][0])
+
+        bytes_per_frame = sum(size for _, size in frames) / len(frames) if frames else 0
+
+        return {
+            'fps': fps,
+            'bytes_per_frame': bytes_per_frame,
+            'stages': stages
+        }
+
+    def format_overlay(self, kind, prefixes=None):
+        summary = self.summary(kind)
+        lines = [
+            f"{kind}: {summary['fps']:.2f} fps, {summary['bytes_per_frame'] / 1024:.1f} KiB/frame"
+        ]
+
+        for name in sorted(summary['stages']):
+            if prefixes and not name.startswith(prefixes):
+                continue
+            lines.append(f"{name}: {summary['stages'][name]:.1f} ms")
+
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        with self.lock:
+            events = list(self.events)
+
+        trace_events = []
+        for name, start, end, tid in events:
+            trace_events.append({
+                'name': name,
+                'cat': name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': self.pid,
+                'tid': tid
+            })
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+        return len(trace_events)
+
+
+class ClockSync:
+    def __init__(self, resync_interval=60, retry_after=10, samples=5):
+        self.offset = 0.0
+        self.rtt = None
+        self.next_sync = 0.0
+        self.resync_interval = resync_interval
+        self.retry_after = retry_after
+        self.samples = samples
+
+    def now(self):
+        return time.time() + self.offset
+
+    def needs_sync(self):
+        return time.time() >= self.next_sync
+
+    def sync(self, api_request):
+        best = None
+
+        for _ in range(self.samples):
+            sent_at = time.time()
+            result = api_request('/api/time')
+            received_at = time.time()
+
+            if 'server_time' not in result:
+                break
+
+            rtt = received_at - sent_at
+            offset = result['server_time'] - (sent_at + received_at) / 2
+            if best is None or rtt < best[0]:
+                best = (rtt, offset)
+
+        if best is None:
+            self.next_sync = time.time() + self.retry_after
+            return False
+
+        self.rtt, self.offset = best
+        self.next_sync = time.time() + self.resync_interval
+        return True
+
+
+class QualityController:
+    LEVELS = [
+        {'format': 'PNG', 'quality': None, 'scale': 1.0},
+        {'format': 'JPEG', 'quality': 90, 'scale': 1.0},
+        {'format': 'JPEG', 'quality': 75, 'scale': 1.0},
+        {'format': 'JPEG', 'quality': 60, 'scale': 0.75},
+        {'format': 'JPEG', 'quality': 50, 'scale': 0.5},
+        {'format': 'JPEG', 'quality': 35, 'scale': 0.35}
+    ]
+
+    def __init__(self, target_latency_ms=1000, smoothing=0.3, upgrade_after=5, headroom=0.7):
+        self.target_latency_ms = target_latency_ms
+        self.smoothing = smoothing
+        self.upgrade_after = upgrade_after
+        self.headroom = headroom
+        self.level = 0
+        self.throughput = None
+        self.frame_latency_ms = None
+        self.level_bytes = {}
+        self.good_frames = 0
+
+    def ewma(self, previous, sample):
+        if previous is None:
+            return sample
+        return previous + self.smoothing * (sample - previous)
+
+    def current(self):
+        return {'level': self.level, **self.LEVELS[self.level]}
+
+    def encode(self, image, level):
+        settings = self.LEVELS[level]
+
+        if settings['scale'] < 1.0:
+            size = (max(1, int(image.width * settings['scale'])), max(1, int(image.height * settings['scale'])))
+            image = image.resize(size, Image.Resampling.BILINEAR)
+
+        buffered = io.BytesIO()
+        if settings['format'] == 'JPEG':
+            image.convert('RGB').save(buffered, format='JPEG', quality=settings['quality'])
+        else:
+            image.save(buffered, format=settings['format'])
+
+        return buffered.getvalue()
+
+    def update(self, level, payload_bytes, send_ms, frame_ms, rtt_ms, failed=False):
+        if not failed:
+            transfer_s = max(send_ms - rtt_ms, 1.0) / 1000
+            self.throughput = self.ewma(self.throughput, payload_bytes / transfer_s)
+            self.level_bytes[level] = self.ewma(self.level_bytes.get(level), payload_bytes)
+        self.frame_latency_ms = self.ewma(self.frame_latency_ms, frame_ms)
+
+        if level != self.level:
+            return
+
+        if self.frame_latency_ms > self.target_latency_ms:
+            self.good_frames = 0
+            if self.level < len(self.LEVELS) - 1:
+                self.level += 1
+                self.frame_latency_ms = None
+            return
+
+        if self.level == 0 or failed or self.throughput is None or level not in self.level_bytes:
+            if failed:
+                self.good_frames = 0
+            return
+
+        better_bytes = self.level_bytes.get(self.level - 1, self.level_bytes[level] * 2)
+        predicted_ms = frame_ms - send_ms + rtt_ms + better_bytes / self.throughput * 1000
+
+        if predicted_ms < self.target_latency_ms * self.headroom:
+            self.good_frames += 1
+            if self.good_frames >= self.upgrade_after:
+                self.level -= 1
+                self.good_frames = 0
+                self.frame_latency_ms = None
+        else:
+            self.good_frames = 0
+
+
+class LanAnnouncer:
+    def __init__(self, group='239.255.42.99', port=50042):
+        self.group = group
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    def announce(self, info):
+        try:
+            self.sock.sendto(json.dumps(info).encode(), (self.group, self.port))
+        except OSError as e:
+            print(f"LAN announce error: {e}")
+
+    def close(self):
+        self.sock.close()
+
+
+class LanDiscovery:
+    def __init__(self, group='239.255.42.99', port=50042, expiry=10):
+        self.group = group
+        self.port = port
+        self.expiry = expiry
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def start(self):
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(('', self.port))
+            membership = struct.pack('4s4s', socket.inet_aton(self.group), socket.inet_aton('0.0.0.0'))
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            sock.setblocking(False)
+        except OSError as e:
+            print(f"LAN discovery unavailable: {e}")
+            return False
+
+        self.sock = sock
+        return True
+
+    def poll(self):
+        while self.sock:
+            try:
+                payload, (address, _) = self.sock.recvfrom(4096)
+            except (BlockingIOError, OSError):
+                break
+
+            try:
+                info = json.loads(payload.decode())
+                server_id = info['server_id']
+                port = int(info['port'])
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            with self.lock:
+                self.peers[server_id] = {
+                    'address': address,
+                    'port': port,
+                    'seen': time.time()
+                }
+
+    def lookup(self, server_id):
+        with self.lock:
+            peer = self.peers.get(server_id)
+
+        if peer and time.time() - peer['seen'] < self.expiry:
+            return peer
+        return None
+
+    def stop(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+class DirectFrameServer:
+    def __init__(self, server_id, direct_key, port=0, session_timeout=60):
+        self.server_id = server_id
+        self.direct_key = direct_key
+        self.frame = None
+        self.session_timeout = session_timeout
+        self.lock = threading.Lock()
+
+        frame_server = self
+
+        class FrameHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+
+                if url.path == '/hello':
+                    query = parse_qs(url.query)
+                    nonce = query.get('nonce', [''])[0]
+                    connection_id = query.get('connection', [''])[0]
+                    if not nonce or not connection_id or len(nonce) > 64 or len(connection_id) > 64:
+                        self.send_json({'error': 'Nonce and connection are required'}, 400)
+                    else:
+                        self.send_json(frame_server.hello(nonce, connection_id), 200)
+                    return
+
+                if url.path != '/frame':
+                    self.send_json({'error': 'Not found'}, 404)
+                    return
+
+                if not frame_server.authorize(
+                        self.headers.get('X-Connection', ''),
+                        self.headers.get('X-Nonce', ''),
+                        self.headers.get('X-Auth', '')
+                ):
+                    self.send_json({'error': 'Invalid direct token'}, 401)
+                    return
+
+                with frame_server.lock:
+                    frame = frame_server.frame
+
+                if frame is None:
+                    self.send_json({'error': 'No screenshot available'}, 404)
+                else:
+                    self.send_json(frame, 200)
+
+            def send_json(self, payload, status):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('0.0.0.0', port), FrameHandler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def sign(key, label, server_id, nonce):
+        message = f"{label}:{server_id}:{nonce}".encode()
+        return hmac.new(key.encode(), message, hashlib.sha256).hexdigest()
+
+    def token_for(self, connection_id):
+        return self.sign(self.direct_key, 'direct', self.server_id, connection_id)
+
+    def nonce_mac(self, connection_id, expires_at, salt):
+        return self.sign(self.direct_key, 'nonce', self.server_id, f"{connection_id}:{expires_at}:{salt}")[:32]
+
+    def hello(self, viewer_nonce, connection_id):
+        expires_at = int(time.time() + self.session_timeout)
+        salt = secrets.token_hex(8)
+        host_nonce = f"{expires_at}.{salt}.{self.nonce_mac(connection_id, expires_at, salt)}"
+
+        return {
+            'server_id': self.server_id,
+            'nonce': host_nonce,
+            'proof': self.sign(self.token_for(connection_id), 'host', self.server_id, viewer_nonce)
+        }
+
+    def authorize(self, connection_id, host_nonce, auth):
+        try:
+            expires_at, salt, mac = host_nonce.split('.')
+            if int(expires_at) < time.time():
+                return False
+        except ValueError:
+            return False
+
+        expected_mac = self.nonce_mac(connection_id, expires_at, salt)
+        if not hmac.compare_digest(expected_mac.encode(), mac.encode('utf-8', 'replace')):
+            return False
+
+        expected = self.sign(self.token_for(connection_id), 'viewer', self.server_id, host_nonce)
+        return hmac.compare_digest(expected.encode(), auth.encode('utf-8', 'replace'))
+
+    def publish(self, frame):
+        with self.lock:
+            self.frame = {'server_id': self.server_id, 'timestamp': time.time(), **frame}
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class DaemonExecutor:
+    def __init__(self, max_workers=4):
+        self.tasks = queue.Queue()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.worker, daemon=True) for _ in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, work, *args):
+        future = Future()
+        if self.stopped:
+            future.cancel()
+            return future
+
+        self.tasks.put((future, work, args))
+        return future
+
+    def worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+
+            future, work, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            try:
+                future.set_result(work(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def shutdown(self):
+        self.stopped = True
+
+        while True:
+            try:
+                task = self.tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is not None:
+                task[0].cancel()
+
+        for _ in self.threads:
+            self.tasks.put(None)
+
+
+class ScheduledJob:
+    def __init__(self, name, interval, work, on_result=None):
+        self.name = name
+        self.interval = interval
+        self.work = work
+        self.on_result = on_result
+        self.after_id = None
+        self.future = None
+        self.started_at = None
+        self.paused = False
+        self.cancelled = False
+        self.rerun = False
+
+
+class TkScheduler:
+    def __init__(self, root, max_workers=4, poll_interval=30):
+        self.root = root
+        self.jobs = {}
+        self.inflight = {}
+        self.executor = DaemonExecutor(max_workers=max_workers)
+        self.completed = queue.Queue()
+        self.poll_interval = poll_interval
+        self.poll_id = self.root.after(self.poll_interval, self.poll)
+
+    def every(self, name, interval, work, on_result=None):
+        self.cancel(name)
+
+        job = ScheduledJob(name, interval, work, on_result)
+        self.jobs[name] = job
+        self.trigger(name)
+        return job
+
+    def is_active(self, name):
+        return name in self.jobs
+
+    def submit(self, work, *args):
+        return self.executor.submit(work, *args)
+
+    def cancel(self, name):
+        job = self.jobs.pop(name, None)
+        if not job:
+            return False
+
+        job.cancelled = True
+        if job.after_id:
+            self.root.after_cancel(job.after_id)
+            job.after_id = None
+        if job.future is not None:
+            self.inflight[name] = job
+        return True
+
+    def pause(self, name):
+        job = self.jobs.get(name)
+        if not job or job.paused:
+            return
+
+        job.paused = True
+        if job.after_id:
+            self.root.after_cancel(job.after_id)
+            job.after_id = None
+
+    def resume(self, name):
+        job = self.jobs.get(name)
+        if not job or not job.paused:
+            return
+
+        job.paused = False
+        if job.future is None:
+            self.trigger(name)
+
+    def trigger(self, name):
+        job = self.jobs.get(name)
+        if not job or job.paused or name in self.inflight:
+            return
+
+        if job.future is not None:
+            job.rerun = True
+            return
+
+        if job.after_id:
+            self.root.after_cancel(job.after_id)
+            job.after_id = None
+
+        job.started_at = time.perf_counter()
+        job.future = self.executor.submit(job.work)
+        job.future.add_done_callback(lambda future, finished=job: self.completed.put(finished))
+
+    def poll(self):
+        while True:
+            try:
+                job = self.completed.get_nowait()
+            except queue.Empty:
+                break
+            self.finish(job)
+
+        self.poll_id = self.root.after(self.poll_interval, self.poll)
+
+    def finish(self, job):
+        future = job.future
+        job.future = None
+
+        if job.cancelled:
+            if self.inflight.get(job.name) is job:
+                del self.inflight[job.name]
+                self.trigger(job.name)
+            return
+
+        try:
+            result = future.result()
+            if job.on_result:
+                job.on_result(result)
+        except Exception as e:
+            print(f"Job {job.name} error: {e}")
+
+        if job.cancelled or job.paused:
+            return
+
+        if job.rerun:
+            job.rerun = False
+            self.trigger(job.name)
+            return
+
+        elapsed_ms = (time.perf_counter() - job.started_at) * 1000
+        delay = max(0, int(job.interval - elapsed_ms))
+        job.after_id = self.root.after(delay, lambda: self.fire(job))
+
+    def fire(self, job):
+        job.after_id = None
+        if self.jobs.get(job.name) is job:
+            self.trigger(job.name)
+
+    def shutdown(self):
+        for name in list(self.jobs):
+            self.cancel(name)
+
+        if self.poll_id:
+            self.root.after_cancel(self.poll_id)
+            self.poll_id = None
+
+        self.executor.shutdown()
+
+
 class SimpleConnectionApp:
     def __init__(self, window):
         self.root = window
         self.root.title("PC Connection Hub")
-        self.root.geometry("1000x600")
+        self.root.geometry("1000x700")
         self.root.configure(bg='white')
 
         self.backend_url = "https://service-zopk.onrender.com"
@@ -22,7 +621,33 @@ class SimpleConnectionApp:
         self.current_connection = None
         self.screenshot_window = None
         self.update_interval = 3000
+        self.thumbnail_interval = 5000
+        self.thumbnail_batch = 50
+        self.thumbnail_size = (80, 45)
+        self.announce_interval = 2000
+        self.discovery_interval = 500
+        self.direct_timeout = 1
+        self.direct_retry_after = 30
         self.screenshot_interval = 2000
+        self.target_frame_latency = 1000
+        self.stats = ClientStats()
+        self.scheduler = TkScheduler(self.root)
+        self.clock = ClockSync()
+        self.frame_id = 0
+        self.last_displayed_frame = None
+        self.last_fetched_frame = None
+        self.quality = QualityController(self.target_frame_latency)
+        self.last_frame_quality = None
+        self.last_frame_path = None
+        self.current_direct = None
+        self.lan_discovery = LanDiscovery()
+        self.lan_announcer = None
+        self.direct_server = None
+        self.direct_failed_until = {}
+        self.direct_sessions = {}
+        self.thumbnail_images = {}
+        self.thumbnail_versions = {}
+        self.search_text = ''
 
         self.name_entry = None
         self.pin_entry = None
@@ -36,11 +661,18 @@ class SimpleConnectionApp:
         self.screenshot_button = None
         self.auto_screenshot_var = None
         self.server_tree = None
-        self.screenshot_thread = None
         self.screenshot_label = None
+        self.stats_label = None
+        self.show_stats_var = None
+        self.upload_stats_label = None
+        self.show_upload_stats_var = None
 
         self.setup_ui()
+        self.root.bind('<Unmap>', self.on_root_unmap)
+        self.root.bind('<Map>', self.on_root_map)
+        self.root.protocol('WM_DELETE_WINDOW', self.on_close)
         self.start_server_updates()
+        self.start_lan_discovery()
 
     def setup_ui(self):
         main_frame = tk.Frame(self.root, bg='white', padx=20, pady=20)
@@ -136,6 +768,41 @@ class SimpleConnectionApp:
         )
         self.status_label.grid(row=4, column=0, columnspan=2, sticky='w', pady=5)
 
+        upload_stats_frame = tk.Frame(form_frame, bg='white')
+        upload_stats_frame.grid(row=5, column=0, columnspan=2, sticky='w')
+
+        self.show_upload_stats_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            upload_stats_frame,
+            text="Show Upload Stats",
+            variable=self.show_upload_stats_var,
+            bg='white',
+            fg='black',
+            font=('Arial', 9),
+            command=self.update_upload_stats
+        ).pack(side='left')
+
+        tk.Button(
+            upload_stats_frame,
+            text="Export Trace",
+            font=('Arial', 9),
+            bg='white',
+            fg='black',
+            relief='solid',
+            bd=1,
+            command=lambda: self.export_trace(self.root)
+        ).pack(side='left', padx=5)
+
+        self.upload_stats_label = tk.Label(
+            form_frame,
+            text="",
+            font=('Courier', 9),
+            bg='black',
+            fg='#00ff00',
+            justify='left',
+            anchor='nw'
+        )
+
         servers_frame = tk.LabelFrame(
             main_frame,
             text=" Available Servers ",
@@ -232,7 +899,8 @@ class SimpleConnectionApp:
                         foreground="black",
                         fieldbackground="white",
                         borderwidth=1,
-                        relief='solid')
+                        relief='solid',
+                        rowheight=self.thumbnail_size[1] + 6)
         style.configure("Treeview.Heading",
                         background="white",
                         foreground="black",
@@ -244,16 +912,18 @@ class SimpleConnectionApp:
         self.server_tree = ttk.Treeview(
             table_frame,
             columns=columns,
-            show='headings',
-            height=8,
+            show='tree headings',
+            height=5,
             style="Treeview"
         )
 
+        self.server_tree.heading('#0', text='Preview')
         self.server_tree.heading('ID', text='Server ID')
         self.server_tree.heading('Name', text='Server Name')
         self.server_tree.heading('Players', text='Players')
         self.server_tree.heading('Status', text='Status')
 
+        self.server_tree.column('#0', width=self.thumbnail_size[0] + 30, stretch=False)
         self.server_tree.column('ID', width=120)
         self.server_tree.column('Name', width=200)
         self.server_tree.column('Players', width=80)
@@ -267,53 +937,93 @@ class SimpleConnectionApp:
 
         self.server_tree.bind('<Double-1>', self.on_double_click)
 
-    def api_request(self, endpoint, method='GET', data=None):
+    def api_request(self, endpoint, method='GET', data=None, stage=None):
         try:
             url = f"{self.backend_url}{endpoint}"
             headers = {'Content-Type': 'application/json'}
             response = None
-
-            if method == 'GET':
-                response = requests.get(url, headers=headers, timeout=10)
-            elif method == 'POST':
-                response = requests.post(url, json=data, headers=headers, timeout=10)
-            elif method == 'PUT':
-                response = requests.put(url, json=data, headers=headers, timeout=10)
-            elif method == 'DELETE':
-                response = requests.delete(url, headers=headers, timeout=10)
+            stage = stage or f"api.{method}"
+
+            with self.stats.stage(stage):
+                if method == 'GET':
+                    response = requests.get(url, headers=headers, timeout=10)
+                elif method == 'POST':
+                    response = requests.post(url, json=data, headers=headers, timeout=10)
+                elif method == 'PUT':
+                    response = requests.put(url, json=data, headers=headers, timeout=10)
+                elif method == 'DELETE':
+                    response = requests.delete(url, headers=headers, timeout=10)
 
             if response:
-                return response.json() if response.content else {}
+                with self.stats.stage(f"{stage}.json"):
+                    return response.json() if response.content else {}
             return {}
         except Exception as e:
             print(f"API Error: {e}")
             return {'error': str(e)}
 
-    def capture_and_upload_screenshot(self):
-        if self.hosting_server and self.auto_screenshot_var.get():
+    def capture_and_upload_screenshot(self, server_id):
+        if self.hosting_server:
             try:
-                screenshot = pyautogui.screenshot()
-                buffered = io.BytesIO()
-                screenshot.save(buffered, format="PNG")
-                img_str = base64.b64encode(buffered.getvalue()).decode()
-                data = {'screenshot': img_str}
-                self.api_request(f'/api/servers/{self.hosting_server["id"]}/screenshot', 'POST', data)
+                if self.clock.needs_sync():
+                    self.sync_clock()
+
+                self.frame_id += 1
+                quality = self.quality.current()
+                frame_start = time.perf_counter()
+                capture_ts = self.clock.now()
+                with self.stats.stage('upload.capture'):
+                    screenshot = pyautogui.screenshot()
+                with self.stats.stage('upload.encode'):
+                    encoded = self.quality.encode(screenshot, quality['level'])
+                with self.stats.stage('upload.base64'):
+                    img_str = base64.b64encode(encoded).decode()
+                data = {
+                    'screenshot': img_str,
+                    'frame_id': self.frame_id,
+                    'capture_ts': capture_ts,
+                    'quality': quality
+                }
+                if self.direct_server:
+                    self.direct_server.publish({
+                        'data': img_str,
+                        'frame_id': self.frame_id,
+                        'capture_ts': capture_ts,
+                        'quality': quality
+                    })
+                send_start = time.perf_counter()
+                result = self.api_request(f'/api/servers/{server_id}/screenshot', 'POST', data, stage='upload.send')
+                send_end = time.perf_counter()
+                self.stats.record_frame('upload', len(encoded))
+
+                self.quality.update(
+                    quality['level'],
+                    len(img_str),
+                    (send_end - send_start) * 1000,
+                    (send_end - frame_start) * 1000,
+                    (self.clock.rtt or 0) * 1000,
+                    failed='error' in result
+                )
             except Exception as e:
                 print(f"Screenshot error: {e}")
 
     def toggle_screenshot_upload(self):
         if self.hosting_server and self.auto_screenshot_var.get():
             self.start_screenshot_upload()
+        else:
+            self.scheduler.cancel('upload')
 
     def start_screenshot_upload(self):
-        def upload_loop():
-            while (self.hosting_server and
-                   self.auto_screenshot_var.get()):
-                self.capture_and_upload_screenshot()
-                time.sleep(self.screenshot_interval / 1000)
+        if self.scheduler.is_active('upload'):
+            return
 
-        self.screenshot_thread = threading.Thread(target=upload_loop, daemon=True)
-        self.screenshot_thread.start()
+        server_id = self.hosting_server['id']
+        self.scheduler.every(
+            'upload',
+            self.screenshot_interval,
+            lambda: self.capture_and_upload_screenshot(server_id),
+            lambda result: self.update_upload_stats()
+        )
 
     def start_hosting(self):
         name = self.name_entry.get().strip()
@@ -343,7 +1053,8 @@ class SimpleConnectionApp:
             'pin': pin_code,
             'max_users': max_users,
             'current_users': 0,
-            'status': 'Open'
+            'status': 'Open',
+            'direct_key': result.get('direct_key')
         }
 
         self.host_button.config(state='disabled')
@@ -355,6 +1066,8 @@ class SimpleConnectionApp:
         if self.auto_screenshot_var.get():
             self.start_screenshot_upload()
 
+        self.start_direct_sharing()
+
         messagebox.showinfo("Success", f"Server '{name}' started!\nServer ID: {server_id}")
         self.refresh_server_list()
 
@@ -372,12 +1085,15 @@ class SimpleConnectionApp:
             self.pin_entry.config(state='normal')
             self.status_label.config(text="Status: Not Hosting")
 
+            self.scheduler.cancel('upload')
+            self.stop_direct_sharing()
             self.hosting_server = None
             self.refresh_server_list()
 
     def refresh_server_list(self):
-        result = self.api_request('/api/servers')
+        self.scheduler.trigger('server_list')
 
+    def populate_server_list(self, result):
         if 'error' in result:
             print(f"Error fetching servers: {result['error']}")
             return
@@ -387,10 +1103,18 @@ class SimpleConnectionApp:
         for item in self.server_tree.get_children():
             self.server_tree.delete(item)
 
+        listed_ids = {server['id'] for server in self.servers}
+        for server_id in list(self.thumbnail_images):
+            if server_id not in listed_ids:
+                del self.thumbnail_images[server_id]
+                self.thumbnail_versions.pop(server_id, None)
+
         for server in self.servers:
             players_text = f"{server['current_users']}/{server['max_users']}"
             self.server_tree.insert(
                 '', 'end',
+                iid=server['id'],
+                image=self.thumbnail_images.get(server['id'], ''),
                 values=(
                     server['id'],
                     server['name'],
@@ -400,17 +1124,189 @@ class SimpleConnectionApp:
             )
 
     def start_server_updates(self):
-        def update_loop():
-            while True:
-                self.refresh_server_list()
-                time.sleep(self.update_interval / 1000)
+        self.scheduler.every(
+            'server_list',
+            self.update_interval,
+            lambda: self.api_request('/api/servers', stage='list.fetch'),
+            self.populate_server_list
+        )
+        self.scheduler.every(
+            'thumbnails',
+            self.thumbnail_interval,
+            self.fetch_thumbnails,
+            self.display_thumbnails
+        )
+
+    def fetch_thumbnails(self):
+        search_text = self.search_text
+        server_ids = [
+            server['id'] for server in self.servers
+            if search_text in server['name'].lower() or search_text in server['id'].lower()
+        ][:self.thumbnail_batch]
+        if not server_ids:
+            return {}
 
-        update_thread = threading.Thread(target=update_loop, daemon=True)
-        update_thread.start()
+        versions = dict(self.thumbnail_versions)
+        known = [f"{server_id}:{versions[server_id]!r}" for server_id in server_ids if server_id in versions]
+        endpoint = f"/api/thumbnails?ids={','.join(server_ids)}"
+        if known:
+            endpoint += f"&known={','.join(known)}"
+
+        result = self.api_request(endpoint, stage='list.thumbnails')
+        if 'error' in result:
+            print(f"Error fetching thumbnails: {result['error']}")
+            return {}
+
+        images = {}
+        for server_id, thumbnail in result.get('thumbnails', {}).items():
+            if not thumbnail:
+                if server_id in versions:
+                    images[server_id] = None
+                continue
+
+            try:
+                image = Image.open(io.BytesIO(base64.b64decode(thumbnail['data'])))
+                image.load()
+                images[server_id] = (thumbnail['timestamp'], image)
+            except Exception as e:
+                print(f"Thumbnail error: {e}")
+
+        return images
+
+    def display_thumbnails(self, images):
+        for server_id, thumbnail in images.items():
+            if thumbnail is None:
+                self.thumbnail_images.pop(server_id, None)
+                self.thumbnail_versions.pop(server_id, None)
+                if self.server_tree.exists(server_id):
+                    self.server_tree.item(server_id, image='')
+                continue
+
+            version, image = thumbnail
+            photo = ImageTk.PhotoImage(image)
+            self.thumbnail_images[server_id] = photo
+            self.thumbnail_versions[server_id] = version
+
+            if self.server_tree.exists(server_id):
+                self.server_tree.item(server_id, image=photo)
+
+    def on_root_unmap(self, event=None):
+        if event is not None and event.widget is self.root:
+            self.scheduler.pause('server_list')
+            self.scheduler.pause('thumbnails')
+
+    def on_root_map(self, event=None):
+        if event is not None and event.widget is self.root:
+            self.scheduler.resume('server_list')
+            self.scheduler.resume('thumbnails')
+
+    def start_lan_discovery(self):
+        if self.lan_discovery.start():
+            self.scheduler.every('lan_discovery', self.discovery_interval, self.lan_discovery.poll)
+
+    def start_direct_sharing(self):
+        if not self.hosting_server.get('direct_key'):
+            return
+
+        try:
+            self.direct_server = DirectFrameServer(self.hosting_server['id'], self.hosting_server['direct_key'])
+            self.lan_announcer = LanAnnouncer()
+        except OSError as e:
+            print(f"Direct sharing unavailable: {e}")
+            self.stop_direct_sharing()
+            return
+
+        info = {
+            'server_id': self.hosting_server['id'],
+            'name': self.hosting_server['name'],
+            'port': self.direct_server.port
+        }
+        self.scheduler.every('lan_announce', self.announce_interval, lambda: self.lan_announcer.announce(info))
+
+    def stop_direct_sharing(self):
+        self.scheduler.cancel('lan_announce')
+
+        if self.lan_announcer:
+            self.lan_announcer.close()
+            self.lan_announcer = None
+
+        if self.direct_server:
+            self.direct_server.shutdown()
+            self.direct_server = None
+
+    def direct_handshake(self, peer, server_id, direct):
+        viewer_nonce = secrets.token_hex(16)
+        response = requests.get(
+            f"http://{peer['address']}:{peer['port']}/hello",
+            params={'nonce': viewer_nonce, 'connection': direct['connection_id']},
+            timeout=self.direct_timeout
+        )
+        result = response.json()
+
+        expected = DirectFrameServer.sign(direct['token'], 'host', server_id, viewer_nonce)
+        if result.get('server_id') != server_id or not hmac.compare_digest(str(result.get('proof', '')), expected):
+            return None
+
+        return {
+            'address': peer['address'],
+            'port': peer['port'],
+            'connection_id': direct['connection_id'],
+            'nonce': result['nonce'],
+            'auth': DirectFrameServer.sign(direct['token'], 'viewer', server_id, result['nonce'])
+        }
+
+    def direct_request(self, peer, server_id, direct):
+        try:
+            for attempt in range(2):
+                session = self.direct_sessions.get(server_id)
+                if (not session or session['address'] != peer['address'] or session['port'] != peer['port'] or
+                        session['connection_id'] != direct['connection_id']):
+                    session = self.direct_handshake(peer, server_id, direct)
+                    if session is None:
+                        print(f"Direct path error: peer for {server_id} failed host verification")
+                        self.direct_failed_until[server_id] = time.time() + self.direct_retry_after
+                        return None
+                    self.direct_sessions[server_id] = session
+
+                response = requests.get(
+                    f"http://{peer['address']}:{peer['port']}/frame",
+                    headers={
+                        'X-Connection': session['connection_id'],
+                        'X-Nonce': session['nonce'],
+                        'X-Auth': session['auth']
+                    },
+                    timeout=self.direct_timeout
+                )
+                if response.status_code != 401:
+                    break
+                self.direct_sessions.pop(server_id, None)
+
+            if response.status_code != 200:
+                return None
+            result = response.json()
+        except Exception as e:
+            print(f"Direct path error: {e}")
+            self.direct_failed_until[server_id] = time.time() + self.direct_retry_after
+            return None
+
+        if result.get('server_id') != server_id:
+            self.direct_failed_until[server_id] = time.time() + self.direct_retry_after
+            return None
+        return result
+
+    def on_close(self):
+        self.stop_direct_sharing()
+        self.lan_discovery.stop()
+        self.scheduler.shutdown()
+        self.root.destroy()
 
     def filter_servers(self, event=None):
         search_text = self.search_entry.get().lower()
 
+        if search_text != self.search_text:
+            self.search_text = search_text
+            self.scheduler.trigger('thumbnails')
+
         for item in self.server_tree.get_children():
             self.server_tree.item(item, tags=('visible',))
 
@@ -463,6 +1359,12 @@ class SimpleConnectionApp:
             return
 
         self.current_connection = server_id
+        self.current_direct = None
+        if result.get('direct_token'):
+            self.current_direct = {
+                'connection_id': result['connection_id'],
+                'token': result['direct_token']
+            }
         self.connect_button.config(state='disabled')
         self.disconnect_button.config(state='normal')
         self.screenshot_button.config(state='normal')
@@ -477,7 +1379,9 @@ class SimpleConnectionApp:
             if 'error' not in result:
                 messagebox.showinfo("Disconnected", "Disconnected from server")
 
+            self.scheduler.cancel('viewer')
             self.current_connection = None
+            self.current_direct = None
             self.connect_button.config(state='normal')
             self.disconnect_button.config(state='disabled')
             self.screenshot_button.config(state='disabled')
@@ -513,41 +1417,215 @@ class SimpleConnectionApp:
         )
         self.screenshot_label.pack(expand=True)
 
+        stats_frame = tk.Frame(self.screenshot_window, bg='white')
+        stats_frame.pack(fill='x', padx=10, pady=(0, 10))
+
+        self.show_stats_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            stats_frame,
+            text="Show Stats",
+            variable=self.show_stats_var,
+            bg='white',
+            fg='black',
+            font=('Arial', 9),
+            command=self.update_stats_overlay
+        ).pack(side='left', padx=5)
+
+        tk.Button(
+            stats_frame,
+            text="Export Trace",
+            font=('Arial', 9),
+            bg='white',
+            fg='black',
+            relief='solid',
+            bd=1,
+            command=self.export_trace
+        ).pack(side='left', padx=5)
+
+        self.stats_label = tk.Label(
+            self.screenshot_window,
+            text="",
+            font=('Courier', 9),
+            bg='black',
+            fg='#00ff00',
+            justify='left',
+            anchor='nw'
+        )
+
+        self.screenshot_window.bind('<Destroy>', self.on_viewer_destroy)
+        self.screenshot_window.bind('<Unmap>', self.on_viewer_unmap)
+        self.screenshot_window.bind('<Map>', self.on_viewer_map)
+
         self.start_screenshot_viewer()
 
+    def sync_clock(self):
+        self.clock.sync(lambda endpoint: self.api_request(endpoint, stage='clock.time'))
+
     def start_screenshot_viewer(self):
-        def update_screenshot():
-            while (self.screenshot_window and
-                   self.screenshot_window.winfo_exists() and
-                   self.current_connection):
-
-                result = self.api_request(f'/api/servers/{self.current_connection}/screenshot')
-
-                if 'data' in result:
-                    try:
-                        image_data = base64.b64decode(result['data'])
-                        image = Image.open(io.BytesIO(image_data))
-
-                        image.thumbnail((780, 580), Image.Resampling.LANCZOS)
-                        photo = ImageTk.PhotoImage(image)
-
-                        self.screenshot_label.configure(image=photo, text="")
-                        self.screenshot_label.image_ref = photo
-                    except Exception as e:
-                        self.screenshot_label.configure(
-                            text=f"Error displaying image: {e}",
-                            image=""
-                        )
-                else:
-                    self.screenshot_label.configure(
-                        text="No screen data available",
-                        image=""
-                    )
+        self.last_displayed_frame = None
+        self.last_fetched_frame = None
+        server_id = self.current_connection
+        direct = self.current_direct
+
+        self.scheduler.every(
+            'viewer',
+            self.screenshot_interval,
+            lambda: self.fetch_screenshot(server_id, direct),
+            self.display_screenshot
+        )
+
+    def fetch_screenshot(self, server_id, direct=None):
+        if self.clock.needs_sync():
+            self.sync_clock()
+
+        result = None
+        peer = self.lan_discovery.lookup(server_id) if direct else None
+        if peer and self.direct_failed_until.get(server_id, 0) < time.time():
+            with self.stats.stage('view.fetch_direct'):
+                result = self.direct_request(peer, server_id, direct)
+
+        if result is not None:
+            result['path'] = 'direct'
+        else:
+            result = self.api_request(f'/api/servers/{server_id}/screenshot', stage='view.fetch')
+            result['path'] = 'relay'
+
+        if 'data' not in result:
+            return result, None, None
+
+        frame_key = result.get('frame_id', result.get('timestamp'))
+        if frame_key is not None and frame_key == self.last_fetched_frame:
+            result['unchanged'] = True
+            return result, None, None
+
+        try:
+            with self.stats.stage('view.base64'):
+                image_data = base64.b64decode(result['data'])
+            with self.stats.stage('view.decode'):
+                image = Image.open(io.BytesIO(image_data))
+                image.load()
+
+            with self.stats.stage('view.resize'):
+                image.thumbnail((780, 580), Image.Resampling.LANCZOS)
+            self.stats.record_frame('view', len(image_data))
+            self.last_fetched_frame = frame_key
+            return result, image, None
+        except Exception as e:
+            return result, None, e
+
+    def display_screenshot(self, fetched):
+        if not self.screenshot_window or not self.screenshot_window.winfo_exists():
+            return
+
+        result, image, error = fetched
+
+        if error is not None:
+            self.screenshot_label.configure(
+                text=f"Error displaying image: {error}",
+                image=""
+            )
+        elif image is not None:
+            with self.stats.stage('view.render'):
+                photo = ImageTk.PhotoImage(image)
+
+                self.screenshot_label.configure(image=photo, text="")
+                self.screenshot_label.image_ref = photo
+            self.report_frame_latency(result)
+            self.last_frame_quality = result.get('quality')
+            self.last_frame_path = result.get('path')
+        elif result.get('unchanged'):
+            self.last_frame_path = result.get('path')
+        else:
+            self.screenshot_label.configure(
+                text="No screen data available",
+                image=""
+            )
+
+        self.update_stats_overlay()
+
+    def on_viewer_destroy(self, event=None):
+        if event is not None and event.widget is self.screenshot_window:
+            self.scheduler.cancel('viewer')
+
+    def on_viewer_unmap(self, event=None):
+        if event is not None and event.widget is self.screenshot_window:
+            self.scheduler.pause('viewer')
+
+    def on_viewer_map(self, event=None):
+        if event is not None and event.widget is self.screenshot_window:
+            self.scheduler.resume('viewer')
+
+    def report_frame_latency(self, frame):
+        frame_id = frame.get('frame_id')
+        capture_ts = frame.get('capture_ts')
+
+        if frame_id is None or capture_ts is None or frame_id == self.last_displayed_frame:
+            return
+
+        self.last_displayed_frame = frame_id
+        latency_ms = (self.clock.now() - capture_ts) * 1000
+        self.stats.record_value('latency.glass_to_glass', latency_ms)
+
+        self.scheduler.submit(
+            self.api_request,
+            f'/api/servers/{self.current_connection}/latency',
+            'POST',
+            {'frame_id': frame_id, 'latency_ms': latency_ms},
+            'view.report_latency'
+        )
+
+    def update_stats_overlay(self):
+        if not self.stats_label or not self.show_stats_var:
+            return
 
-                time.sleep(self.screenshot_interval / 1000)
+        if self.show_stats_var.get():
+            text = self.stats.format_overlay('view', ('view.', 'latency.'))
+            if self.last_frame_quality:
+                text += f"\nquality: {self.format_quality(self.last_frame_quality)}"
+            if self.last_frame_path:
+                text += f"\npath: {self.last_frame_path}"
+            self.stats_label.configure(text=text)
+            self.stats_label.place(x=10, y=10)
+            self.stats_label.lift()
+        else:
+            self.stats_label.place_forget()
+
+    def update_upload_stats(self):
+        if not self.upload_stats_label or not self.show_upload_stats_var:
+            return
+
+        if self.show_upload_stats_var.get():
+            text = self.stats.format_overlay('upload', ('upload.',))
+            text += f"\nquality: {self.format_quality(self.quality.current())}"
+            self.upload_stats_label.configure(text=text)
+            self.upload_stats_label.grid(row=6, column=0, columnspan=2, sticky='w', pady=5)
+        else:
+            self.upload_stats_label.grid_remove()
 
-        viewer_thread = threading.Thread(target=update_screenshot, daemon=True)
-        viewer_thread.start()
+    @staticmethod
+    def format_quality(quality):
+        text = f"L{quality.get('level')} {quality.get('format')}"
+        if quality.get('quality'):
+            text += f" q{quality['quality']}"
+        return text + f" {int(quality.get('scale', 1.0) * 100)}%"
+
+    def export_trace(self, parent=None):
+        parent = parent or self.screenshot_window
+        path = filedialog.asksaveasfilename(
+            parent=parent,
+            title="Export Chrome Trace",
+            defaultextension=".json",
+            initialfile="client_trace.json",
+            filetypes=[("Chrome Trace", "*.json")]
+        )
+        if not path:
+            return
+
+        try:
+            count = self.stats.export_chrome_trace(path)
+            messagebox.showinfo("Trace Exported", f"Wrote {count} events to {path}", parent=parent)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to export trace: {e}", parent=parent)
 
     def on_double_click(self, event=None):
         self.connect_to_server()
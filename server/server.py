@@ -1,14 +1,43 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+from PIL import Image
 import uuid
 import time
+import base64
+import io
+import math
+import hmac
+import hashlib
+import secrets
+from collections import deque
 
 app = Flask(__name__)
 CORS(app)
 
 servers = {}
 screenshots = {}
+latencies = {}
+thumbnails = {}
+direct_keys = {}
 server_timeout = 300
+latency_window = 500
+thumbnail_size = (80, 45)
+thumbnail_quality = 40
+thumbnail_batch_limit = 50
+quality_formats = ('PNG', 'JPEG')
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def is_frame_id(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_quality(value):
+    return (isinstance(value, dict) and
+            is_frame_id(value.get('level')) and value['level'] >= 0 and
+            value.get('format') in quality_formats and
+            (value.get('quality') is None or is_number(value['quality'])) and
+            is_number(value.get('scale')) and 0 < value['scale'] <= 1)
 
 class ServerManager:
     @staticmethod
@@ -24,6 +53,12 @@ class ServerManager:
             del servers[server_id]
             if server_id in screenshots:
                 del screenshots[server_id]
+            if server_id in latencies:
+                del latencies[server_id]
+            if server_id in thumbnails:
+                del thumbnails[server_id]
+            if server_id in direct_keys:
+                del direct_keys[server_id]
 
     @staticmethod
     def create_server(name, pin_code, max_users):
@@ -40,6 +75,7 @@ class ServerManager:
             'last_updated': time.time(),
             'connections': []
         }
+        direct_keys[server_id] = secrets.token_hex(32)
 
         return server_id
 
@@ -63,6 +99,12 @@ class ServerManager:
             del servers[server_id]
             if server_id in screenshots:
                 del screenshots[server_id]
+            if server_id in latencies:
+                del latencies[server_id]
+            if server_id in thumbnails:
+                del thumbnails[server_id]
+            if server_id in direct_keys:
+                del direct_keys[server_id]
             return True
         return False
 
@@ -76,21 +118,36 @@ class ServerManager:
         if server_id not in servers:
             return False
 
+        connection_id = str(uuid.uuid4())
         servers[server_id]['connections'].append({
-            'id': str(uuid.uuid4()),
+            'id': connection_id,
             'connected_at': time.time(),
             **connection_data
         })
         servers[server_id]['last_updated'] = time.time()
-        return True
+        return connection_id
+
+    @staticmethod
+    def issue_direct_token(server_id, connection_id):
+        if server_id not in direct_keys:
+            return None
+
+        message = f"direct:{server_id}:{connection_id}".encode()
+        return hmac.new(direct_keys[server_id].encode(), message, hashlib.sha256).hexdigest()
 
     @staticmethod
-    def store_screenshot(server_id, screenshot_data):
+    def store_screenshot(server_id, screenshot_data, frame_id=None, capture_ts=None, quality=None):
         try:
+            received_at = time.time()
             screenshots[server_id] = {
                 'data': screenshot_data,
-                'timestamp': time.time()
+                'timestamp': received_at,
+                'frame_id': frame_id,
+                'capture_ts': capture_ts,
+                'quality': quality
             }
+            if capture_ts is not None:
+                ServerManager.record_latency(server_id, 'upload', (received_at - capture_ts) * 1000)
             return True
         except Exception as e:
             print(f"Error storing screenshot: {e}")
@@ -105,6 +162,73 @@ class ServerManager:
                 del screenshots[server_id]
         return None
 
+    @staticmethod
+    def get_thumbnail(server_id):
+        if server_id not in servers or servers[server_id]['pin']:
+            return None
+
+        screenshot = ServerManager.get_screenshot(server_id)
+        if not screenshot:
+            thumbnails.pop(server_id, None)
+            return None
+
+        cached = thumbnails.get(server_id)
+        if cached and cached['timestamp'] == screenshot['timestamp']:
+            return cached if cached['data'] else None
+
+        try:
+            image = Image.open(io.BytesIO(base64.b64decode(screenshot['data'])))
+            image.thumbnail(thumbnail_size, Image.Resampling.BILINEAR)
+            buffered = io.BytesIO()
+            image.convert('RGB').save(buffered, format='JPEG', quality=thumbnail_quality)
+        except Exception as e:
+            print(f"Error generating thumbnail: {e}")
+            thumbnails[server_id] = {'data': None, 'timestamp': screenshot['timestamp']}
+            return None
+
+        thumbnails[server_id] = {
+            'data': base64.b64encode(buffered.getvalue()).decode(),
+            'frame_id': screenshot.get('frame_id'),
+            'timestamp': screenshot['timestamp']
+        }
+        return thumbnails[server_id]
+
+    @staticmethod
+    def record_latency(server_id, kind, latency_ms):
+        if server_id not in servers:
+            return False
+
+        if server_id not in latencies:
+            latencies[server_id] = {}
+        if kind not in latencies[server_id]:
+            latencies[server_id][kind] = deque(maxlen=latency_window)
+
+        latencies[server_id][kind].append(latency_ms)
+        return True
+
+    @staticmethod
+    def get_latency_stats(server_id):
+        stats = {}
+
+        for kind, samples in latencies.get(server_id, {}).items():
+            ordered = sorted(samples)
+            if not ordered:
+                continue
+
+            def percentile(p):
+                return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+            stats[kind] = {
+                'count': len(ordered),
+                'mean_ms': sum(ordered) / len(ordered),
+                'p50_ms': percentile(50),
+                'p90_ms': percentile(90),
+                'p99_ms': percentile(99),
+                'max_ms': ordered[-1]
+            }
+
+        return stats
+
 @app.route('/api/servers', methods=['GET'])
 def get_servers():
     servers_list = ServerManager.get_all_servers()
@@ -123,6 +247,7 @@ def create_server():
     server_id = ServerManager.create_server(name, pin_code, max_users)
     return jsonify({
         'server_id': server_id,
+        'direct_key': direct_keys[server_id],
         'message': f'Server "{name}" created successfully'
     })
 
@@ -166,13 +291,15 @@ def connect_to_server(server_id):
 
     server['last_updated'] = time.time()
 
-    ServerManager.add_connection(server_id, {
+    connection_id = ServerManager.add_connection(server_id, {
         'user_name': data.get('user_name', 'Anonymous')
     })
 
     return jsonify({
         'message': f'Connected to {server["name"]}',
-        'server_name': server['name']
+        'server_name': server['name'],
+        'connection_id': connection_id,
+        'direct_token': ServerManager.issue_direct_token(server_id, connection_id)
     })
 
 @app.route('/api/servers/<server_id>/disconnect', methods=['POST'])
@@ -199,7 +326,17 @@ def upload_screenshot(server_id):
     if not screenshot_data:
         return jsonify({'error': 'Screenshot data is required'}), 400
 
-    if ServerManager.store_screenshot(server_id, screenshot_data):
+    if data.get('frame_id') is not None and not is_frame_id(data['frame_id']):
+        return jsonify({'error': 'Frame id must be an integer'}), 400
+
+    if data.get('capture_ts') is not None and not is_number(data['capture_ts']):
+        return jsonify({'error': 'Capture timestamp must be a number'}), 400
+
+    if data.get('quality') is not None and not is_quality(data['quality']):
+        return jsonify({'error': 'Quality must include level, format, quality and scale'}), 400
+
+    if ServerManager.store_screenshot(server_id, screenshot_data, data.get('frame_id'), data.get('capture_ts'),
+                                      data.get('quality')):
         return jsonify({'message': 'Screenshot uploaded successfully'})
     else:
         return jsonify({'error': 'Failed to store screenshot'}), 500
@@ -212,6 +349,60 @@ def get_screenshot(server_id):
     else:
         return jsonify({'error': 'No screenshot available'}), 404
 
+@app.route('/api/servers/<server_id>/latency', methods=['POST'])
+def report_latency(server_id):
+    data = request.json
+    latency_ms = data.get('latency_ms')
+
+    if latency_ms is None:
+        return jsonify({'error': 'Latency is required'}), 400
+
+    if not is_number(latency_ms):
+        return jsonify({'error': 'Latency must be a number'}), 400
+
+    if data.get('frame_id') is not None and not is_frame_id(data['frame_id']):
+        return jsonify({'error': 'Frame id must be an integer'}), 400
+
+    if ServerManager.record_latency(server_id, 'glass_to_glass', float(latency_ms)):
+        return jsonify({'message': 'Latency recorded'})
+    else:
+        return jsonify({'error': 'Server not found'}), 404
+
+@app.route('/api/servers/<server_id>/latency', methods=['GET'])
+def get_latency(server_id):
+    if server_id not in servers:
+        return jsonify({'error': 'Server not found'}), 404
+
+    return jsonify(ServerManager.get_latency_stats(server_id))
+
+@app.route('/api/thumbnails', methods=['GET'])
+def get_thumbnails():
+    server_ids = [server_id for server_id in request.args.get('ids', '').split(',') if server_id]
+
+    if len(server_ids) > thumbnail_batch_limit:
+        return jsonify({'error': f'At most {thumbnail_batch_limit} server ids per request'}), 400
+
+    known = {}
+    for entry in request.args.get('known', '').split(','):
+        server_id, _, timestamp = entry.partition(':')
+        try:
+            known[server_id] = float(timestamp)
+        except ValueError:
+            continue
+
+    result = {}
+    for server_id in server_ids:
+        thumbnail = ServerManager.get_thumbnail(server_id)
+        if thumbnail and known.get(server_id) == thumbnail['timestamp']:
+            continue
+        result[server_id] = thumbnail
+
+    return jsonify({'thumbnails': result})
+
+@app.route('/api/time', methods=['GET'])
+def get_time():
+    return jsonify({'server_time': time.time()})
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy', 'server_count': len(servers)})